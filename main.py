@@ -1,11 +1,19 @@
-import markdown
+import aiofiles
+import asyncio
+import cmarkgfm
+import hmac
+import os
 import re
+import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
 from datetime import datetime
 from fastapi import FastAPI, Request, Depends, HTTPException, Header, Form, status
 from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from jinja2 import FileSystemBytecodeCache
 from pydantic import BaseModel
 import pandas as pd # 引入 pandas 以处理空 CSV 异常
 from fastapi.responses import RedirectResponse
@@ -22,13 +30,34 @@ REPORT_DIR = ledger.REPORT_DIR
 class IPAuthorizationError(Exception):
     pass
 
-# 已授权的ip
-AUTHORIZED_IPS = set()
+# 已授权的ip: ip -> 过期时间 (time.monotonic)
+AUTHORIZED_IPS: dict = {}
+AUTH_TTL_S = 24 * 3600
+AUTH_MAX_IPS = 10_000
+
+def authorize_ip(ip: str):
+    """授权 IP，超出上限时淘汰最早授权的 IP"""
+    AUTHORIZED_IPS.pop(ip, None)
+    AUTHORIZED_IPS[ip] = time.monotonic() + AUTH_TTL_S
+    while len(AUTHORIZED_IPS) > AUTH_MAX_IPS:
+        AUTHORIZED_IPS.pop(next(iter(AUTHORIZED_IPS)))
+
+class ReportStaticFiles(StaticFiles):
+    """报告图片：新增记录后会以相同文件名重新生成，因此不能标记为 immutable。
+    使用 no-cache 让浏览器每次带 ETag/Last-Modified 协商，未变化时只返回 304，不传输图片。"""
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = "no-cache"
+        return response
 
 app = FastAPI(title="Ledger Fusion Pro")
 app.mount("/static", StaticFiles(directory=BASE_DIR / "static"), name="static")
-app.mount("/reports_static", StaticFiles(directory=REPORT_DIR), name="reports_static")
+app.mount("/reports_static", ReportStaticFiles(directory=REPORT_DIR), name="reports_static")
 templates = Jinja2Templates(directory=BASE_DIR / "templates")
+# 模板编译结果缓存到磁盘，worker 重启后无需重新编译
+JINJA_CACHE_DIR = BASE_DIR / ".jinja_cache"
+JINJA_CACHE_DIR.mkdir(exist_ok=True)
+templates.env.bytecode_cache = FileSystemBytecodeCache(directory=str(JINJA_CACHE_DIR), pattern="__jinja2_%s.cache")
 templates.env.globals['now'] = datetime.now
 
 @app.exception_handler(IPAuthorizationError)
@@ -52,44 +81,128 @@ class Record(BaseModel):
     note: str = ""
 
 # --- 4. 辅助函数 ---
+# 报告中的图片只写了文件名，渲染成 HTML 后统一改写到 /reports_static/ 下
+_HTML_IMG_RE = re.compile(r'<img ([^>]*?)src="([^"]+)"')
+
 def render_markdown_to_html(md_content: str) -> str:
-    def replace_image_path(match):
-        alt_text, image_name = match.groups()
-        return f'<img src="/reports_static/{image_name}" alt="{alt_text}" class="report-image">'
-    md_content_with_fixed_images = re.sub(r'!\[(.*?)\]\((.*?)\)', replace_image_path, md_content)
-    return markdown.markdown(md_content_with_fixed_images, extensions=['tables', 'fenced_code'])
+    # cmark-gfm (C 实现) 原生支持表格和代码块
+    html = cmarkgfm.github_flavored_markdown_to_html(md_content)
+    return _HTML_IMG_RE.sub(r'<img \1class="report-image" src="/reports_static/\2"', html)
+
+# 已渲染报告的缓存: 路径 -> (mtime_ns, size, html)，export_md 重写文件后键自然失效
+_REPORT_HTML_CACHE: "OrderedDict[str, tuple[int, int, str]]" = OrderedDict()
+_REPORT_HTML_CACHE_SIZE = 64
+
+async def _get_report_html(md_file: Path) -> str:
+    """返回报告的 HTML，文件未变化时直接使用缓存"""
+    st = await asyncio.to_thread(md_file.stat)
+    key = str(md_file)
+    cached = _REPORT_HTML_CACHE.get(key)
+    if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+        _REPORT_HTML_CACHE.move_to_end(key)
+        return cached[2]
+    async with aiofiles.open(md_file, 'r', encoding='utf-8') as fh:
+        md_content = await fh.read()
+    html = render_markdown_to_html(md_content)
+    _REPORT_HTML_CACHE[key] = (st.st_mtime_ns, st.st_size, html)
+    _REPORT_HTML_CACHE.move_to_end(key)
+    if len(_REPORT_HTML_CACHE) > _REPORT_HTML_CACHE_SIZE:
+        _REPORT_HTML_CACHE.popitem(last=False)
+    return html
+
+def _list_reports() -> list:
+    """扫描报告目录，返回首页展示用的报告列表（阻塞 I/O，在线程中执行）"""
+    reports = []
+    with os.scandir(REPORT_DIR) as it:
+        for de in it:
+            if de.name.endswith(".md") and not de.name.startswith('.'):
+                reports.append((de.name, de.stat().st_mtime))
+    reports.sort(reverse=True)
+    return [
+        {"name": name[:-3], "mtime": datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M')}
+        for name, mtime in reports
+    ]
+
+# 类别列表缓存: (各 CSV 的文件名/mtime/大小, 类别列表)
+_CATEGORIES_CACHE: tuple = ((), [])
 
 def get_all_categories() -> list:
     """重写 ledger.list_categories() 以返回列表而不是打印"""
+    global _CATEGORIES_CACHE
+    key = []
+    with os.scandir(DATA_DIR) as it:
+        for entry in it:
+            if entry.name.endswith(".csv") and entry.is_file():
+                st = entry.stat()
+                key.append((entry.name, st.st_mtime_ns, st.st_size))
+    key = tuple(sorted(key))
+    if _CATEGORIES_CACHE[0] == key:
+        return _CATEGORIES_CACHE[1]
     categories = set()
-    for csv_file in DATA_DIR.glob("*.csv"):
+    for name, _, _ in key:
+        csv_file = DATA_DIR / name
         try:
-            df = pd.read_csv(csv_file)
-            if "category" in df.columns:
-                categories.update(df["category"].dropna().unique())
-        except (pd.errors.EmptyDataError, FileNotFoundError):
+            # 只读取 category 一列
+            df = pd.read_csv(csv_file, usecols=["category"], dtype={"category": "string"}, engine="c")
+            categories.update(df["category"].dropna().unique())
+        except (pd.errors.EmptyDataError, FileNotFoundError, ValueError):
             continue
-    return sorted(list(categories))
+    result = sorted(categories)
+    _CATEGORIES_CACHE = (key, result)
+    return result
+
+# 导出在工作线程中执行；matplotlib 的 pyplot 不是线程安全的，所有导出串行执行
+_EXPORT_LOCK = threading.Lock()
+
+def _export_month_report(month: str):
+    """重新生成月度报告（阻塞，在线程中执行）"""
+    with _EXPORT_LOCK:
+        ledger.export_md(month)
+
+def _export_year_report(year: str):
+    """重新生成年度报告（阻塞，在线程中执行）"""
+    with _EXPORT_LOCK:
+        ledger_pro.export_multi_month_md(ledger_pro.get_months_in_year(year), year=year)
+
+# 同一月份短时间内多次新增记录时，只在最后一次之后导出一次
+EXPORT_DEBOUNCE_S = 1.0
+_pending_exports: dict = {}
+
+async def _debounced_export(month: str, delay: float):
+    await asyncio.sleep(delay)
+    # 等待结束即从待办表移除：导出开始后不再被取消，期间新增的记录会另外安排一次导出
+    if _pending_exports.get(month) is asyncio.current_task():
+        del _pending_exports[month]
+    try:
+        await asyncio.to_thread(_export_month_report, month)
+    except Exception as e:
+        # 后台任务没有调用方接收异常，在这里打印到服务器日志
+        print(f"❌ 后台导出 {month} 月报告失败: {e!r}")
+
+def _schedule_export(month: str, delay: float = EXPORT_DEBOUNCE_S):
+    """安排导出某月报告，取消该月仍在等待中（尚未开始导出）的任务"""
+    pending = _pending_exports.get(month)
+    if pending is not None:
+        pending.cancel()
+    _pending_exports[month] = asyncio.create_task(_debounced_export(month, delay))
 
 # 🆕 2. 修改依赖项，使其在验证失败时抛出异常
 async def verify_ip_authorization(request: Request):
     """
     检查 IP 是否已授权。如果未授权，则抛出 IPAuthorizationError 异常。
     """
-    if request.client.host not in AUTHORIZED_IPS:
+    expires = AUTHORIZED_IPS.get(request.client.host)
+    if expires is None:
+        raise IPAuthorizationError()
+    if expires < time.monotonic():
+        AUTHORIZED_IPS.pop(request.client.host, None)
         raise IPAuthorizationError()
 
 # --- 5. Web 界面路由 ---
 
 @app.get("/", response_class=HTMLResponse)
 async def route_index(request: Request, message: str = None):
-    reports_info = []
-    for f in sorted(REPORT_DIR.iterdir(), reverse=True):
-        if f.suffix == ".md" and not f.name.startswith('.'):
-            reports_info.append({
-                "name": f.name.replace('.md', ''),
-                "mtime": datetime.fromtimestamp(f.stat().st_mtime).strftime('%Y-%m-%d %H:%M')
-            })
+    reports_info = await asyncio.to_thread(_list_reports)
     return templates.TemplateResponse("index.html", {
         "request": request,
         "reports": reports_info,
@@ -101,7 +214,7 @@ async def route_manage(request: Request, message: str = None):
     """🆕 显示管理页面的路由"""
     return templates.TemplateResponse("manage.html", {
         "request": request,
-        "categories": get_all_categories(),
+        "categories": await asyncio.to_thread(get_all_categories),
         "today_date": datetime.now().strftime("%Y-%m-%d"),
         "message": message
     })
@@ -116,11 +229,11 @@ async def route_add_record(
 ):
     """🆕 处理添加记录表单提交的路由"""
     try:
-        ledger.add_record(date, category, amount, type, note)
-        # 自动更新当月报告
+        await asyncio.to_thread(ledger.add_record, date, category, amount, type, note)
+        # 自动更新当月报告（响应返回后在后台执行）
         month = date[:7]
-        ledger.export_md(month)
-        message = f"✅ 添加成功！记录已保存，{month} 的报告已更新。"
+        _schedule_export(month)
+        message = f"✅ 添加成功！记录已保存，{month} 的报告正在后台更新。"
     except Exception as e:
         message = f"❌ 添加失败: {e}"
     
@@ -138,11 +251,10 @@ async def route_export_report(month: str = Form(None), year: str = Form(None)):
     
     try:
         if year:
-            months_in_year = ledger_pro.get_months_in_year(year)
-            ledger_pro.export_multi_month_md(months_in_year, year=year)
+            await asyncio.to_thread(_export_year_report, year)
             message = f"✅ 导出成功！{year} 年的年度报告已生成。"
         else: # month
-            ledger.export_md(month)
+            await asyncio.to_thread(_export_month_report, month)
             message = f"✅ 导出成功！{month} 的月度报告已生成。"
     except Exception as e:
         message = f"❌ 导出失败: {e}"
@@ -159,21 +271,21 @@ async def route_view_report_login(request: Request, month_or_year: str, error: s
 @app.post("/report/{month_or_year}", response_class=HTMLResponse)
 async def route_process_report_login(request: Request, month_or_year: str, password: str = Form(...)):
     md_file = REPORT_DIR / f"{month_or_year}.md"
-    if not md_file.exists():
+    if not await asyncio.to_thread(md_file.exists):
         raise HTTPException(status_code=404, detail="报告文件不存在")
     if '_annual' in month_or_year:
-        password_suffix = month_or_year.split('_')[0][2:]
+        password_suffix = month_or_year[2:4]                    # 'YYYY_annual' -> 'YY'
     else:
-        password_suffix = month_or_year.split('-')[1]
+        password_suffix = month_or_year[5:].partition('-')[0]   # 'YYYY-MM' -> 'MM'
     correct_password = f"pwdtemp{password_suffix}"
-    if password != correct_password:
+    # 常数时间比较，避免通过响应时间推测密码
+    if not hmac.compare_digest(password.encode('utf-8'), correct_password.encode('utf-8')):
         return templates.TemplateResponse("login.html", {
             "request": request, "month_or_year": month_or_year, "error": "密码错误，请重试。"
         }, status_code=401)
-    AUTHORIZED_IPS.add(request.client.host)
-    print(f"授权 IP: {request.client.host}。当前授权列表: {AUTHORIZED_IPS}") # 在服务器后台打印日志
-    md_content = md_file.read_text(encoding='utf-8')
-    html_content = render_markdown_to_html(md_content)
+    authorize_ip(request.client.host)
+    print(f"授权 IP: {request.client.host}。当前授权数量: {len(AUTHORIZED_IPS)}") # 在服务器后台打印日志
+    html_content = await _get_report_html(md_file)
     return templates.TemplateResponse("report_view.html", {
         "request": request, "month_or_year": month_or_year, "report_content": html_content
     })
@@ -186,24 +298,26 @@ async def route_download_file(file_type: str, month_or_year: str):
         file_path = DATA_DIR / f"{month_or_year.split('_')[0]}.csv"
     else:
         raise HTTPException(status_code=400, detail="无效的文件类型")
-    if not file_path.exists():
+    if not await asyncio.to_thread(file_path.exists):
         raise HTTPException(status_code=404, detail="文件不存在")
-    return FileResponse(file_path, filename=file_path.name)
+    # FileResponse 自身在线程中分块读取文件，不会阻塞事件循环
+    return FileResponse(path=file_path, filename=file_path.name)
 
 # --- 6. REST API 路由 (保持不变) ---
 # ... (此部分代码省略，与上一版本相同) ...
-API_KEY = "apikeytemp"
+API_KEY = b"apikeytemp"
 async def verify_api_key(x_api_key: str = Header(...)):
-    if x_api_key != API_KEY:
+    # 常数时间比较，避免通过响应耗时逐字节猜出 API Key
+    if not hmac.compare_digest(x_api_key.encode('utf-8'), API_KEY):
         raise HTTPException(status_code=401, detail="无效的 API Key")
 
 @app.post("/api/add", status_code=status.HTTP_201_CREATED, dependencies=[Depends(verify_api_key)])
 async def api_add_record(record: Record):
     try:
-        ledger.add_record(record.date, record.category, record.amount, record.type, record.note)
+        await asyncio.to_thread(ledger.add_record, record.date, record.category, record.amount, record.type, record.note)
         month = record.date[:7]
-        ledger.export_md(month)
-        return {"status": "success", "data": record.dict(), "message": f"记录已添加，{month} 的报告已更新。"}
+        _schedule_export(month)
+        return {"status": "success", "data": record.dict(), "message": f"记录已添加，{month} 的报告正在后台更新。"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"处理请求时发生错误: {e}")
 
@@ -213,11 +327,10 @@ async def api_export_report(month: str = Form(None), year: str = Form(None)):
         raise HTTPException(status_code=400, detail="必须提供 'month' 或 'year' 参数。")
     try:
         if year:
-            months_in_year = ledger_pro.get_months_in_year(year)
-            ledger_pro.export_multi_month_md(months_in_year, year=year)
+            await asyncio.to_thread(_export_year_report, year)
             message = f"年度报告 {year}_annual.md 已成功导出。"
         else:
-            ledger.export_md(month)
+            await asyncio.to_thread(_export_month_report, month)
             message = f"月度报告 {month}.md 已成功导出。"
         return {"status": "success", "message": message}
     except Exception as e:
@@ -225,6 +338,17 @@ async def api_export_report(month: str = Form(None), year: str = Form(None)):
 
 
 # --- 7. 启动应用 ---
+# LEDGER_DEV=1 开启热重载；LEDGER_WORKERS 指定 worker 数量。
+# 注意：已授权 IP 等状态保存在各个 worker 进程内存中，多 worker 时需要在每个 worker 上分别授权，
+# 因此默认只启动 1 个 worker。uvloop/httptools 安装后（uvicorn[standard]）会被自动使用。
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8001, reload=True)
\ No newline at end of file
+    dev_mode = os.getenv("LEDGER_DEV") == "1"
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8001,
+        reload=dev_mode,
+        workers=1 if dev_mode else int(os.getenv("LEDGER_WORKERS", "1")),
+        access_log=dev_mode,
+    )
\ No newline at end of file
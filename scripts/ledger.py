@@ -16,12 +16,14 @@ ledger.py - 简易记账命令行工具
 """
 
 import argparse
-import argcomplete
+import csv
+import threading
+import numpy as np
 import pandas as pd
 from pathlib import Path
 import datetime
-import matplotlib.pyplot as plt
-from matplotlib import rcParams
+import io
+from functools import lru_cache
 
 # 导入 ledger_pro.py (假设此文件存在并包含多月/年度处理逻辑)
 try:
@@ -46,42 +48,118 @@ REPORT_DIR = BASE_DIR / "reports"
 DATA_DIR.mkdir(exist_ok=True)
 REPORT_DIR.mkdir(exist_ok=True)
 
-# 设置中文字体为系统字体（Mac 上一般是 "Songti SC" 或 "Heiti SC"）
-# 这应该在导入 matplotlib 后尽早设置
-rcParams['font.sans-serif'] = ['Songti SC', 'Arial Unicode MS'] # 增加备用字体
-rcParams['axes.unicode_minus'] = False                       # 正确显示负号
-
+# matplotlib 导入较慢，只在第一次画图时导入（Web 服务启动时不需要）
+_plt = None
+
+def get_pyplot():
+    """返回已配置好的 matplotlib.pyplot，首次调用时导入"""
+    global _plt
+    if _plt is None:
+        import matplotlib
+        matplotlib.use("Agg")  # 服务端只需要输出图片，不需要交互式后端
+        import matplotlib.pyplot as plt
+        from matplotlib import rcParams
+        # 设置中文字体为系统字体（Mac 上一般是 "Songti SC" 或 "Heiti SC"）
+        rcParams['font.sans-serif'] = ['Songti SC', 'Arial Unicode MS'] # 增加备用字体
+        rcParams['axes.unicode_minus'] = False                       # 正确显示负号
+        _plt = plt
+    return _plt
+
+@lru_cache(maxsize=64)
 def get_csv_path(month: str):
     return DATA_DIR / f"{month}.csv"
 
+RECORD_COLUMNS = ["date", "category", "amount", "type", "note"]
+
 def ensure_csv(month: str):
     path = get_csv_path(month)
     if not path.exists():
-        df = pd.DataFrame(columns=["date", "category", "amount", "type", "note"])
+        df = pd.DataFrame(columns=RECORD_COLUMNS)
         df.to_csv(path, index=False)
     return path
 
+# 显式指定列类型，省去 pandas 的类型推断；type 用 category，比较时只比较整数编码
+CSV_DTYPES = {"category": "string", "amount": "float64", "type": "category", "note": "string"}
+
+# 已解析的月度 CSV: 路径 -> (mtime_ns, size, DataFrame)；追加记录会改变 mtime/大小，缓存自然失效
+_CSV_CACHE: dict = {}
+
+def read_csv_cached(path: Path) -> pd.DataFrame:
+    """读取 CSV，文件未变化时返回缓存 DataFrame 的副本"""
+    st = path.stat()
+    key = (st.st_mtime_ns, st.st_size)
+    hit = _CSV_CACHE.get(path)
+    if hit and hit[:2] == key:
+        return hit[2].copy()
+    df = pd.read_csv(path, engine="c", dtype=CSV_DTYPES, parse_dates=["date"])
+    _CSV_CACHE[path] = (*key, df)
+    return df.copy()
+
+def type_masks(df: pd.DataFrame):
+    """扫描一次 type 列，返回 (收入掩码, 支出掩码)；category 类型时直接比较整数编码"""
+    types = df["type"]
+    if not isinstance(types.dtype, pd.CategoricalDtype):
+        types = types.to_numpy()
+        return types == "income", types == "expense"
+    codes = types.array.codes
+    categories = list(types.dtype.categories)
+    # 本月没有的类型用 -2 表示，避免与缺失值的编码 -1 相等
+    income, expense = (categories.index(v) if v in categories else -2 for v in ("income", "expense"))
+    return codes == income, codes == expense
+
+def category_sums(df: pd.DataFrame, mask=None) -> pd.Series:
+    """按类别汇总金额，结果与 groupby("category")["amount"].sum() 相同（按类别排序）。
+    月度数据行数不多，np.unique + np.bincount 比 pandas groupby 的调度开销小得多。"""
+    categories = df["category"]
+    valid = categories.notna().to_numpy()
+    if mask is not None:
+        valid = valid & mask
+    cats, inverse = np.unique(categories.to_numpy()[valid], return_inverse=True)
+    sums = np.bincount(inverse, weights=df["amount"].to_numpy()[valid], minlength=len(cats))
+    return pd.Series(sums, index=pd.Index(cats, name="category"), name="amount")
+
+def markdown_table_rows(df: pd.DataFrame, amount_format="{}") -> str:
+    """把记录格式化为 Markdown 表格行（日期 | 类别 | 金额 | 类型 | 备注），各字段原样写入不做转义"""
+    amounts = map(amount_format.format, df["amount"].to_numpy())
+    return "".join(f"| {d} | {c} | {a} | {t} | {n} |\n" for d, c, a, t, n in zip(
+        df["date"].dt.strftime("%Y-%m-%d"), df["category"].fillna(""), amounts, df["type"], df["note"].fillna("")))
+
+def save_figure(fig, path: Path):
+    """保存图表：先 tight_layout 排版一次，再渲染到内存，最后一次写入文件。
+    不使用 bbox_inches="tight"，它会为计算边界额外渲染一遍。"""
+    fig.tight_layout()
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png")
+    with open(path, "wb") as f:
+        f.write(buf.getbuffer())
+
+# Web 服务会在多个线程中新增记录，建表头和追加写入需要串行
+_APPEND_LOCK = threading.Lock()
+
 def add_record(date, category, amount, record_type="expense", note=""):
-    """新增记录，可为收入或支出"""
+    """新增记录，可为收入或支出（直接追加一行，不重写整个文件）"""
     month = date[:7]
-    path = ensure_csv(month)
-    df = pd.read_csv(path)
-    new_record = pd.DataFrame([[date, category, float(amount), record_type, note]],
-                              columns=df.columns)
-    df = pd.concat([df, new_record], ignore_index=True)
-    df.to_csv(path, index=False)
-    print("✅ 已添加:", new_record.to_dict(orient="records")[0])
+    amount = float(amount)
+    with _APPEND_LOCK:
+        path = ensure_csv(month)
+        with open(path, "a", encoding="utf-8", newline="") as f:
+            csv.writer(f, lineterminator="\n").writerow([date, category, amount, record_type, note])
+    print("✅ 已添加:", {"date": date, "category": category, "amount": amount, "type": record_type, "note": note})
 
 def generate_report(month):
     """生成月度汇总（收入/支出/净额）"""
-    path = ensure_csv(month)
-    df = pd.read_csv(path)
-    if df.empty:
+    # 只读操作不创建空 CSV，文件不存在即视为没有记录
+    path = get_csv_path(month)
+    df = read_csv_cached(path) if path.exists() else None
+    if df is None or df.empty:
         print(f"⚠️ {month} 本月没有记录")
         return
 
-    income = df[df["type"]=="income"]["amount"].sum()
-    expense = df[df["type"]=="expense"]["amount"].sum()
+    # 掩码在汇总与分类统计中复用
+    is_income, is_expense = type_masks(df)
+    amounts = df["amount"].to_numpy()
+    income = amounts[is_income].sum()
+    expense = amounts[is_expense].sum()
     net = income - expense
 
     print(f"\n📊 {month} 收入/支出汇总:")
@@ -89,7 +167,7 @@ def generate_report(month):
     print("支出:", expense, "元")
     print("净额:", net, "元")
     print("\n各类别支出汇总:")
-    summary = df[df["type"]=="expense"].groupby("category")["amount"].sum().sort_values(ascending=False)
+    summary = category_sums(df, is_expense).sort_values(ascending=False)
     if summary.empty:
         print("无支出记录。")
     else:
@@ -98,22 +176,26 @@ def generate_report(month):
 def export_md(month):
     """导出 Markdown 报告，并生成饼图 & 累计支出折线图 & 每日支出折线图 & 每周汇总"""
     
-    path = ensure_csv(month)
-    df = pd.read_csv(path)
-
-    if df.empty:
+    path = get_csv_path(month)
+    df = read_csv_cached(path) if path.exists() else None
+    if df is None or df.empty:
         print(f"⚠️ {month} 本月没有记录，无法生成报告。")
         return
 
-    # 确保日期列是 datetime 类型
-    df["date"] = pd.to_datetime(df["date"])
     df = df.sort_values(by="date", ascending=True)
+    # 收入/支出掩码供下面各处复用
+    is_income, is_expense = type_masks(df)
     
+    # 饼图和折线图各复用一个 Figure，每张图前 clear 即可
+    plt = get_pyplot()
+    pie_fig, pie_ax = plt.subplots(figsize=(6,6))
+    line_fig, line_ax = plt.subplots(figsize=(10,5))
+
     pie_path = None
     line_path = None
     daily_line_path = None
     weekly_pie_paths = []
-    weekly_expense_md = ""
+    weekly_parts = []  # 每周汇总的 Markdown 片段
 
     # ========= 每周汇总功能开始 =========
     # 确保只有在处理单个月份时才生成每周汇总，否则多月报告的周数会混乱
@@ -129,122 +211,108 @@ def export_md(month):
         end_of_month = min(end_of_month, df["date"].max())
 
 
-        # 循环生成每周汇总
-        week_num = 1
-        current_week_start = start_of_month
-        
-        while current_week_start <= end_of_month:
-            current_week_end = current_week_start + pd.DateOffset(days=6) # 一周是7天，从current_week_start算起6天后是这周的最后一天
+        # 一次分组得到每周各类别支出：第 1 周为 1-7 日，第 2 周为 8-14 日，以此类推
+        exp = df.loc[is_expense, ["date", "category", "amount"]].copy()
+        exp["week"] = (exp["date"] - start_of_month).dt.days // 7 + 1
+        weekly = exp.groupby(["week", "category"])["amount"].sum()
+
+        for week_num, weekly_expense_summary in weekly.groupby(level="week"):
+            weekly_expense_summary = weekly_expense_summary.droplevel("week").sort_values(ascending=False)
+            current_week_start = start_of_month + pd.DateOffset(days=(week_num - 1) * 7)
             # 确保周结束日期不超过月末
-            if current_week_end > end_of_month:
-                current_week_end = end_of_month
-
-            weekly_df = df[(df["date"] >= current_week_start) & (df["date"] <= current_week_end) & (df["type"] == "expense")]
-            weekly_expense_summary = weekly_df.groupby("category")["amount"].sum().sort_values(ascending=False)
-
-            if not weekly_expense_summary.empty:
-                weekly_expense_md += f"\n### 第 {week_num} 周支出汇总 ({current_week_start.strftime('%Y-%m-%d')} 至 {current_week_end.strftime('%Y-%m-%d')})\n\n"
-                weekly_expense_md += f"| 类别 | 金额 |\n|------|------|\n"
-                for category, amount in weekly_expense_summary.items():
-                    weekly_expense_md += f"| {category} | {amount:.2f} |\n"
-                weekly_expense_md += f"**本周总支出:** {weekly_expense_summary.sum():.2f} 元\n\n"
-
-                # 生成每周饼图
-                plt.figure(figsize=(6,6))
-                plt.pie(weekly_expense_summary, labels=weekly_expense_summary.index, autopct="%1.1f%%", startangle=140)
-                plt.title(f"{month} 第 {week_num} 周各类别支出占比")
-                weekly_pie_path = REPORT_DIR / f"{month}_week{week_num}_pie.png"
-                plt.savefig(weekly_pie_path, bbox_inches="tight")
-                plt.close()
-                weekly_pie_paths.append(weekly_pie_path)
-                weekly_expense_md += f"![第 {week_num} 周支出分类饼图]({weekly_pie_path.name})\n\n"
-            
-            # 移动到下一周的开始
-            current_week_start = current_week_end + pd.DateOffset(days=1)
-            week_num += 1
+            current_week_end = min(current_week_start + pd.DateOffset(days=6), end_of_month)
+
+            weekly_parts.append(f"\n### 第 {week_num} 周支出汇总 ({current_week_start.strftime('%Y-%m-%d')} 至 {current_week_end.strftime('%Y-%m-%d')})\n\n")
+            weekly_parts.append(f"| 类别 | 金额 |\n|------|------|\n")
+            weekly_parts.append("".join(f"| {category} | {amount:.2f} |\n" for category, amount in weekly_expense_summary.items()))
+            weekly_parts.append(f"\n**本周总支出:** {weekly_expense_summary.sum():.2f} 元\n\n")
+
+            # 生成每周饼图
+            pie_ax.clear()
+            pie_ax.pie(weekly_expense_summary, labels=weekly_expense_summary.index, autopct="%1.1f%%", startangle=140)
+            pie_ax.set_title(f"{month} 第 {week_num} 周各类别支出占比")
+            weekly_pie_path = REPORT_DIR / f"{month}_week{week_num}_pie.png"
+            save_figure(pie_fig, weekly_pie_path)
+            weekly_pie_paths.append(weekly_pie_path)
+            weekly_parts.append(f"![第 {week_num} 周支出分类饼图]({weekly_pie_path.name})\n\n")
     # ========= 每周汇总功能结束 =========
 
     # 生成饼图（支出分类占比）
-    expense_summary = df[df["type"]=="expense"].groupby("category")["amount"].sum()
+    expense_summary = category_sums(df, is_expense)
     if not expense_summary.empty:
-        plt.figure(figsize=(6,6))
-        plt.pie(expense_summary, labels=expense_summary.index, autopct="%1.1f%%", startangle=140)
-        plt.title(f"{month} 各类别支出占比")
+        pie_ax.clear()
+        pie_ax.pie(expense_summary, labels=expense_summary.index, autopct="%1.1f%%", startangle=140)
+        pie_ax.set_title(f"{month} 各类别支出占比")
         pie_path = REPORT_DIR / f"{month}_pie.png"
-        plt.savefig(pie_path, bbox_inches="tight")
-        plt.close()
+        save_figure(pie_fig, pie_path)
     
     # 生成累计支出折线图
     # 将日期转换为日期对象以便正确排序和分组
-    df_expense = df[df["type"]=="expense"].copy()
+    df_expense = df[is_expense].copy()
     if not df_expense.empty:
         df_expense["date"] = df_expense["date"].dt.date
         daily_expense = df_expense.groupby("date")["amount"].sum().sort_index()
         
         if not daily_expense.empty:
-            plt.figure(figsize=(10,5))
-            plt.plot(daily_expense.index, daily_expense.cumsum(), marker="o")
-            plt.title(f"{month} 累计支出走势")
-            plt.xlabel("日期")
-            plt.ylabel("累计金额")
-            plt.grid(True)
-            plt.xticks(rotation=45)
-            plt.tight_layout()
+            line_ax.clear()
+            line_ax.plot(daily_expense.index, daily_expense.cumsum(), marker="o")
+            line_ax.set_title(f"{month} 累计支出走势")
+            line_ax.set_xlabel("日期")
+            line_ax.set_ylabel("累计金额")
+            line_ax.grid(True)
+            line_ax.tick_params(axis="x", labelrotation=45)
             line_path = REPORT_DIR / f"{month}_line.png"
-            plt.savefig(line_path, bbox_inches="tight")
-            plt.close()
+            save_figure(line_fig, line_path)
 
             # 生成每日支出折线图
-            plt.figure(figsize=(10,5))
-            plt.plot(daily_expense.index, daily_expense, marker="s", linestyle="-", color="orange")
-            plt.title(f"{month} 每日支出走势")
-            plt.xlabel("日期")
-            plt.ylabel("每日支出金额")
-            plt.grid(True)
-            plt.xticks(rotation=45)
-            plt.tight_layout()
+            line_ax.clear()
+            line_ax.plot(daily_expense.index, daily_expense, marker="s", linestyle="-", color="orange")
+            line_ax.set_title(f"{month} 每日支出走势")
+            line_ax.set_xlabel("日期")
+            line_ax.set_ylabel("每日支出金额")
+            line_ax.grid(True)
+            line_ax.tick_params(axis="x", labelrotation=45)
             daily_line_path = REPORT_DIR / f"{month}_daily_line.png"
-            plt.savefig(daily_line_path, bbox_inches="tight")
-            plt.close()
+            save_figure(line_fig, daily_line_path)
 
-    # 构造 Markdown 内容
-    md = f"# {month} 月账单\n\n"
+    plt.close(pie_fig)
+    plt.close(line_fig)
+
+    # 构造 Markdown 内容：先收集片段，最后一次性拼接写入
+    parts = [f"# {month} 月账单\n\n"]
     
     # 插入每周汇总内容
-    md += weekly_expense_md
+    parts.extend(weekly_parts)
 
-    md += f"# 月总账单\n\n"
+    parts.append(f"# 月总账单\n\n")
 
-    md += f"| 日期 | 类别 | 金额 | 类型 | 备注 |\n|------|------|------|------|------|\n"
-    for _, row in df.iterrows():
-        # 注意：这里row['date']已经是datetime对象，需要格式化
-        md += f"| {row['date'].strftime('%Y-%m-%d')} | {row['category']} | {row['amount']:.2f} | {row['type']} | {row['note']} |\n"
+    parts.append(f"| 日期 | 类别 | 金额 | 类型 | 备注 |\n|------|------|------|------|------|\n")
+    parts.append(markdown_table_rows(df, amount_format="{:.2f}"))
 
-    income_total = df[df['type']=='income']['amount'].sum()
-    expense_total = df[df['type']=='expense']['amount'].sum()
+    amounts = df["amount"].to_numpy()
+    income_total = amounts[is_income].sum()
+    expense_total = amounts[is_expense].sum()
     net_total = income_total - expense_total
 
-    md += f'\n## 各类支出汇总： \n'
-    md += f"| 类别 | 金额 |\n|------|------|\n"
-    for category, amount in expense_summary.items():
-        md += f"|{category}|{amount:.2f}|\n"
+    parts.append(f'\n## 各类支出汇总： \n')
+    parts.append(f"| 类别 | 金额 |\n|------|------|\n")
+    parts.append("".join(f"|{category}|{amount:.2f}|\n" for category, amount in expense_summary.items()))
 
-    md += f"\n## 本月小结\n- 收入: {income_total:.2f} 元\n"
-    md += f"- 支出: {expense_total:.2f} 元\n"
-    md += f"- 净额: {net_total:.2f} 元\n"
+    parts.append(f"\n## 本月小结\n- 收入: {income_total:.2f} 元\n")
+    parts.append(f"- 支出: {expense_total:.2f} 元\n")
+    parts.append(f"- 净额: {net_total:.2f} 元\n")
 
     # 插入图表
     if pie_path:
-        md += f"\n## 支出分类饼图\n![]({pie_path.name})\n"
+        parts.append(f"\n## 支出分类饼图\n![]({pie_path.name})\n")
     if line_path:
-        md += f"\n## 累计支出曲线\n![]({line_path.name})\n"
+        parts.append(f"\n## 累计支出曲线\n![]({line_path.name})\n")
     if daily_line_path:
-        md += f"\n## 每日支出曲线\n![]({daily_line_path.name})\n"
+        parts.append(f"\n## 每日支出曲线\n![]({daily_line_path.name})\n")
     
     # 保存 Markdown
     md_path = REPORT_DIR / f"{month}.md"
-    with open(md_path, "w", encoding="utf-8") as f:
-        f.write(md)
+    md_path.write_bytes("".join(parts).encode("utf-8"))
     print(f"✅ 已导出 Markdown 报告 → {md_path}")
     if pie_path:
         print(f"📊 饼图 → {pie_path}")
@@ -280,6 +348,8 @@ def list_categories():
 
 
 def main():
+    import argcomplete
+
     parser = argparse.ArgumentParser(
         description="简易记账工具（收入/支出），支持新增记录、查看汇总、导出报告"
     )
@@ -1,29 +1,28 @@
 # ledger_pro.py
 
+import numpy as np
 import pandas as pd
 from pathlib import Path
-import matplotlib.pyplot as plt
-from matplotlib import rcParams
-import datetime
+from functools import lru_cache
 
 # 继承 ledger.py 中的一些常量和函数
-from .ledger import DATA_DIR, REPORT_DIR, get_csv_path, ensure_csv
-
-# 设置中文字体为系统字体
-rcParams['font.sans-serif'] = ['Songti SC']
-rcParams['axes.unicode_minus'] = False
+# matplotlib 由 ledger.get_pyplot() 在首次画图时导入并设置中文字体
+from .ledger import (DATA_DIR, REPORT_DIR, RECORD_COLUMNS, category_sums, get_csv_path, ensure_csv, get_pyplot,
+                     markdown_table_rows, read_csv_cached, save_figure, type_masks)
 
 def get_monthly_data(month: str):
-    """获取指定月份的DataFrame，如果不存在则返回空的DataFrame"""
+    """获取指定月份的DataFrame（date 列已解析为日期），如果不存在则返回空的DataFrame"""
     path = get_csv_path(month)
     if path.exists():
-        return pd.read_csv(path)
-    return pd.DataFrame(columns=["date", "category", "amount", "type", "note"])
-
-def calculate_monthly_summary(df_month: pd.DataFrame):
-    """计算单个月份的收入、支出和净额"""
-    income = df_month[df_month["type"] == "income"]["amount"].sum()
-    expense = df_month[df_month["type"] == "expense"]["amount"].sum()
+        return read_csv_cached(path)
+    return pd.DataFrame(columns=RECORD_COLUMNS)
+
+def calculate_monthly_summary(df_month: pd.DataFrame, masks=None):
+    """计算单个月份的收入、支出和净额；masks 为 type_masks() 的结果，可复用"""
+    is_income, is_expense = masks if masks is not None else type_masks(df_month)
+    amounts = df_month["amount"].to_numpy()
+    income = amounts[is_income].sum()
+    expense = amounts[is_expense].sum()
     net = income - expense
     return income, expense, net
 # ledger_pro.py
@@ -34,8 +33,8 @@ def generate_multi_month_report(months: list):
     total_income_all_months = 0
     total_expense_all_months = 0
     
-    all_income_categories = pd.Series(dtype=float) # 用于汇总所有月份的收入类别
-    all_expense_categories = pd.Series(dtype=float) # 用于汇总所有月份的支出类别
+    monthly_income_summaries = [] # 各月收入类别汇总，最后合并为总计
+    monthly_expense_summaries = [] # 各月支出类别汇总，最后合并为总计
 
     monthly_summary_data = [] # 存储每月汇总数据
 
@@ -45,9 +44,9 @@ def generate_multi_month_report(months: list):
             print(f"⚠️ {month} 月没有记录")
             continue
         
-        df_month["date"] = pd.to_datetime(df_month["date"])
         df_month = df_month.sort_values(by="date", ascending=True)
-        income, expense, net = calculate_monthly_summary(df_month)
+        is_income, is_expense = masks = type_masks(df_month)
+        income, expense, net = calculate_monthly_summary(df_month, masks)
         total_income_all_months += income
         total_expense_all_months += expense
         
@@ -64,18 +63,21 @@ def generate_multi_month_report(months: list):
         print(f"  净额: {net:.2f} 元")
         
         # 月度支出类别汇总
-        expense_summary = df_month[df_month["type"] == "expense"].groupby("category")["amount"].sum().sort_values(ascending=False)
+        expense_summary = category_sums(df_month, is_expense).sort_values(ascending=False)
         if not expense_summary.empty:
             print("  各类别支出汇总:")
             print(expense_summary.to_string(header=False))
-            all_expense_categories = all_expense_categories.add(expense_summary, fill_value=0) # 累加到总计
+            monthly_expense_summaries.append(expense_summary)
         
         # 月度收入类别汇总 (新增)
-        income_summary = df_month[df_month["type"] == "income"].groupby("category")["amount"].sum().sort_values(ascending=False)
+        income_summary = category_sums(df_month, is_income).sort_values(ascending=False)
         if not income_summary.empty:
             print("  各类别收入汇总:")
             print(income_summary.to_string(header=False))
-            all_income_categories = all_income_categories.add(income_summary, fill_value=0) # 累加到总计
+            monthly_income_summaries.append(income_summary)
+
+    all_income_categories = _merge_category_sums(monthly_income_summaries)
+    all_expense_categories = _merge_category_sums(monthly_expense_summaries)
 
     print("\n--- 总计 ---")
     print(f"总收入: {total_income_all_months:.2f} 元")
@@ -95,6 +97,63 @@ def generate_multi_month_report(months: list):
 
     return monthly_summary_data # 返回月度汇总数据供后续图表使用
 
+def _reset_figure(fig, width, height):
+    """清空复用的 Figure 并设置尺寸，返回新的 Axes"""
+    fig.clf()
+    fig.set_size_inches(width, height)
+    return fig.add_subplot()
+
+def _daily_cumsum(dates, amounts):
+    """按天汇总金额并累加，返回 (日期数组, 累计金额数组)
+
+    日期截断为 datetime64[D] 后用 np.unique + np.bincount 分组，不必为每行生成 datetime.date 对象。
+    """
+    unique_days, inverse = np.unique(dates.astype("datetime64[D]"), return_inverse=True)
+    daily = np.bincount(inverse, weights=amounts, minlength=len(unique_days))
+    return unique_days, np.cumsum(daily)
+
+def _merge_category_sums(summaries) -> pd.Series:
+    """合并各月的类别汇总（category_sums 的结果），结果按类别排序"""
+    if not summaries:
+        return pd.Series(dtype=float)
+    cats, inverse = np.unique(np.concatenate([s.index.to_numpy() for s in summaries]), return_inverse=True)
+    sums = np.bincount(inverse, weights=np.concatenate([s.to_numpy() for s in summaries]), minlength=len(cats))
+    return pd.Series(sums, index=pd.Index(cats, name="category"), name="amount")
+
+# ---- 图表渲染 ----
+# 图表先收集为 (渲染函数, 参数) 任务，Markdown 组装完成后在同一个 Figure 上依次渲染。
+
+def _render_pie(fig, path, size, title, values, labels):
+    ax = _reset_figure(fig, *size)
+    ax.pie(values, labels=labels, autopct="%1.1f%%", startangle=140)
+    ax.set_title(title)
+    save_figure(fig, path)
+
+def _render_lines(fig, path, size, title, xlabel, ylabel, series, rotate_xticks=False, legend=False):
+    """series 为 [(x, y, plot 参数), ...]"""
+    ax = _reset_figure(fig, *size)
+    for x, y, style in series:
+        ax.plot(x, y, **style)
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.grid(True)
+    if legend:
+        ax.legend()
+    if rotate_xticks:
+        ax.tick_params(axis="x", labelrotation=45)
+    save_figure(fig, path)
+
+def _render_charts(tasks):
+    """渲染全部图表任务，复用一个 Figure 依次渲染"""
+    plt = get_pyplot()
+    fig = plt.figure()
+    try:
+        for render, args in tasks:
+            render(fig, *args)
+    finally:
+        plt.close(fig)
+
 def export_multi_month_md(months: list, year: str = None):
     """
     导出多月或年度的 Markdown 报告，包括每月图表和总计图表。
@@ -106,154 +165,127 @@ def export_multi_month_md(months: list, year: str = None):
         output_filename_prefix = f"{months[0]}_to_{months[-1]}"
     else: # 只有单个月份，这种情况在ledger.py中已经处理，这里是为了保险
         output_filename_prefix = months[0]
-        
-    md = f"# {output_filename_prefix} 账单报告\n\n"
-    all_dfs = []
-    
-    monthly_summary_data = [] # 用于绘制月级收入支出折线图
-
-    # 用于汇总所有月份的类别数据
-    total_income_categories = pd.Series(dtype=float)
-    total_expense_categories = pd.Series(dtype=float)
 
+    # 每月用 NumPy 分组汇总，总计由各月结果合并，不再拼接出包含所有记录的大 DataFrame
+    month_frames = []
     for month in sorted(months):
         df_month = get_monthly_data(month)
-        if df_month.empty:
-            continue
+        if not df_month.empty:
+            month_frames.append((month, df_month))
 
-        all_dfs.append(df_month)
-        
-        income, expense, net = calculate_monthly_summary(df_month)
+    if not month_frames:
+        print("⚠️ 没有可用的数据进行汇总和导出。")
+        return
+
+    monthly_income_summaries = []
+    monthly_expense_summaries = []
+    expense_dates = []  # 各月支出的日期和金额，最后合并计算总计累计走势
+    expense_amounts = []
+
+    chart_tasks = []  # 图表任务，Markdown 组装完成后统一渲染
+    chart_logs = []
+    md_parts = [f"# {output_filename_prefix} 账单报告\n\n"]  # Markdown 片段，最后一次性拼接
+    monthly_summary_data = [] # 用于绘制月级收入支出折线图
+
+    for month, df_month in month_frames:
+        is_income, is_expense = masks = type_masks(df_month)
+        income, expense, net = calculate_monthly_summary(df_month, masks)
         monthly_summary_data.append({
             "month": month,
             "income": income,
             "expense": expense
         })
 
-        md += f"## {month} 月账单\n\n"
-        md += f"| 日期 | 类别 | 金额 | 类型 | 备注 |\n|------|------|------|------|------|\n"
-        for _, row in df_month.iterrows():
-            md += f"| {row['date']} | {row['category']} | {row['amount']} | {row['type']} | {row['note']} |\n"
+        md_parts.append(f"## {month} 月账单\n\n")
+        md_parts.append(f"| 日期 | 类别 | 金额 | 类型 | 备注 |\n|------|------|------|------|------|\n")
+        md_parts.append(markdown_table_rows(df_month, amount_format="{:.2f}"))
 
-        md += f"\n### {month} 月小结\n- 收入: {income:.2f} 元\n"
-        md += f"- 支出: {expense:.2f} 元\n"
-        md += f"- 净额: {net:.2f} 元\n"
+        md_parts.append(f"\n### {month} 月小结\n- 收入: {income:.2f} 元\n")
+        md_parts.append(f"- 支出: {expense:.2f} 元\n")
+        md_parts.append(f"- 净额: {net:.2f} 元\n")
 
         # 月度支出类别汇总表格 (新增)
-        expense_summary = df_month[df_month["type"] == "expense"].groupby("category")["amount"].sum().sort_values(ascending=False)
+        expense_summary = category_sums(df_month, is_expense).sort_values(ascending=False)
+        monthly_expense_summaries.append(expense_summary)
         if not expense_summary.empty:
-            md += f"\n#### {month} 月各类别支出汇总\n\n| 类别 | 金额 |\n|------|------|\n"
-            for category, amount in expense_summary.items():
-                md += f"| {category} | {amount:.2f} |\n"
-            total_expense_categories = total_expense_categories.add(expense_summary, fill_value=0) # 累加到总计
+            md_parts.append(f"\n#### {month} 月各类别支出汇总\n\n| 类别 | 金额 |\n|------|------|\n")
+            md_parts.append("".join(f"| {category} | {amount:.2f} |\n" for category, amount in expense_summary.items()))
 
         # 月度收入类别汇总表格 (新增)
-        income_summary = df_month[df_month["type"] == "income"].groupby("category")["amount"].sum().sort_values(ascending=False)
+        income_summary = category_sums(df_month, is_income).sort_values(ascending=False)
+        monthly_income_summaries.append(income_summary)
         if not income_summary.empty:
-            md += f"\n#### {month} 月各类别收入汇总\n\n| 类别 | 金额 |\n|------|------|\n"
-            for category, amount in income_summary.items():
-                md += f"| {category} | {amount:.2f} |\n"
-            total_income_categories = total_income_categories.add(income_summary, fill_value=0) # 累加到总计
+            md_parts.append(f"\n#### {month} 月各类别收入汇总\n\n| 类别 | 金额 |\n|------|------|\n")
+            md_parts.append("".join(f"| {category} | {amount:.2f} |\n" for category, amount in income_summary.items()))
 
 
         # 生成每月饼图
         if not expense_summary.empty:
-            plt.figure(figsize=(6, 6))
-            plt.pie(expense_summary, labels=expense_summary.index, autopct="%1.1f%%", startangle=140)
-            plt.title(f"{month} 各类别支出占比")
             pie_path = REPORT_DIR / f"{month}_{output_filename_prefix}_pie.png"
-            plt.savefig(pie_path, bbox_inches="tight")
-            plt.close()
-            md += f"\n#### 支出分类饼图\n![]({pie_path.name})\n"
-            print(f"📊 {month} 饼图 → {pie_path}")
+            chart_tasks.append((_render_pie, (pie_path, (6, 6), f"{month} 各类别支出占比",
+                                              expense_summary.to_numpy(), list(expense_summary.index))))
+            md_parts.append(f"\n#### 支出分类饼图\n![]({pie_path.name})\n")
+            chart_logs.append(f"📊 {month} 饼图 → {pie_path}")
 
         # 生成每月累计支出折线图
-        df_month["date"] = pd.to_datetime(df_month["date"])
-        df_month_expense = df_month[df_month["type"] == "expense"].sort_values("date")
-        daily_expense = df_month_expense.groupby(df_month_expense["date"].dt.date)["amount"].sum()
-
-        if not daily_expense.empty:
-            plt.figure(figsize=(10, 5))
-            plt.plot(daily_expense.index, daily_expense.cumsum(), marker="o")
-            plt.title(f"{month} 累计支出走势")
-            plt.xlabel("日期")
-            plt.ylabel("累计金额")
-            plt.grid(True)
+        expense_dates.append(df_month["date"].to_numpy()[is_expense])
+        expense_amounts.append(df_month["amount"].to_numpy()[is_expense])
+        expense_days, expense_cumsum = _daily_cumsum(expense_dates[-1], expense_amounts[-1])
+
+        if len(expense_days):
             line_path = REPORT_DIR / f"{month}_{output_filename_prefix}_line.png"
-            plt.savefig(line_path, bbox_inches="tight")
-            plt.close()
-            md += f"\n#### 累计支出曲线\n![]({line_path.name})\n"
-            print(f"📈 {month} 折线图 → {line_path}")
+            chart_tasks.append((_render_lines, (line_path, (10, 5), f"{month} 累计支出走势", "日期", "累计金额",
+                                                [(expense_days, expense_cumsum, {"marker": "o"})])))
+            md_parts.append(f"\n#### 累计支出曲线\n![]({line_path.name})\n")
+            chart_logs.append(f"📈 {month} 折线图 → {line_path}")
 
-        md += "\n---\n\n" # 分隔线
+        md_parts.append("\n---\n\n") # 分隔线
 
-    if not all_dfs:
-        print("⚠️ 没有可用的数据进行汇总和导出。")
-        return
+    # 所有月份的类别总计（按类别排序）
+    total_income_summary = _merge_category_sums(monthly_income_summaries)
+    total_expense_summary = _merge_category_sums(monthly_expense_summaries)
 
-    # 合并所有数据
-    df_all = pd.concat(all_dfs, ignore_index=True)
-
-    md += "## 所有月份汇总\n\n"
+    md_parts.append("## 所有月份汇总\n\n")
 
     # 总计收入类别汇总表格 (新增)
-    if not total_income_categories.empty:
-        md += f"### 所有月份收入类别总计\n\n| 类别 | 金额 |\n|------|------|\n"
-        for category, amount in total_income_categories.sort_values(ascending=False).items():
-            md += f"| {category} | {amount:.2f} |\n"
-        md += "\n"
+    if not total_income_summary.empty:
+        md_parts.append(f"### 所有月份收入类别总计\n\n| 类别 | 金额 |\n|------|------|\n")
+        md_parts.append("".join(f"| {category} | {amount:.2f} |\n" for category, amount in total_income_summary.sort_values(ascending=False).items()))
+        md_parts.append("\n")
 
     # 总计支出类别汇总表格 (新增)
-    if not total_expense_categories.empty:
-        md += f"### 所有月份支出类别总计\n\n| 类别 | 金额 |\n|------|------|\n"
-        for category, amount in total_expense_categories.sort_values(ascending=False).items():
-            md += f"| {category} | {amount:.2f} |\n"
-        md += "\n"
+    if not total_expense_summary.empty:
+        md_parts.append(f"### 所有月份支出类别总计\n\n| 类别 | 金额 |\n|------|------|\n")
+        md_parts.append("".join(f"| {category} | {amount:.2f} |\n" for category, amount in total_expense_summary.sort_values(ascending=False).items()))
+        md_parts.append("\n")
 
     # 总计饼图 (所有月)
-    total_expense_summary = df_all[df_all["type"] == "expense"].groupby("category")["amount"].sum()
     if not total_expense_summary.empty:
-        plt.figure(figsize=(8, 8))
-        plt.pie(total_expense_summary, labels=total_expense_summary.index, autopct="%1.1f%%", startangle=140)
-        plt.title(f"{output_filename_prefix} 所有类别支出占比")
         total_pie_path = REPORT_DIR / f"{output_filename_prefix}_total_pie.png"
-        plt.savefig(total_pie_path, bbox_inches="tight")
-        plt.close()
-        md += f"\n### 所有月份支出分类饼图\n![]({total_pie_path.name})\n"
-        print(f"📊 总计饼图 → {total_pie_path}")
+        chart_tasks.append((_render_pie, (total_pie_path, (8, 8), f"{output_filename_prefix} 所有类别支出占比",
+                                          total_expense_summary.to_numpy(), list(total_expense_summary.index))))
+        md_parts.append(f"\n### 所有月份支出分类饼图\n![]({total_pie_path.name})\n")
+        chart_logs.append(f"📊 总计饼图 → {total_pie_path}")
 
     
     # 总计收入饼图 (所有月)
-    total_income_summary = df_all[df_all["type"] == "income"].groupby("category")["amount"].sum()
     if not total_income_summary.empty:
-        plt.figure(figsize=(8, 8))
-        plt.pie(total_income_summary, labels=total_income_summary.index, autopct="%1.1f%%", startangle=140)
-        plt.title(f"{output_filename_prefix} 所有类别收入占比")
         total_pie_path = REPORT_DIR / f"{output_filename_prefix}_total_income_pie.png"
-        plt.savefig(total_pie_path, bbox_inches="tight")
-        plt.close()
-        md += f"\n### 所有月份收入分类饼图\n![]({total_pie_path.name})\n"
-        print(f"📊 总计饼图 → {total_pie_path}")
+        chart_tasks.append((_render_pie, (total_pie_path, (8, 8), f"{output_filename_prefix} 所有类别收入占比",
+                                          total_income_summary.to_numpy(), list(total_income_summary.index))))
+        md_parts.append(f"\n### 所有月份收入分类饼图\n![]({total_pie_path.name})\n")
+        chart_logs.append(f"📊 总计饼图 → {total_pie_path}")
 
     # 总计日级支出走势图 (所有月)
-    df_all["date"] = pd.to_datetime(df_all["date"])
-    df_all_expense = df_all[df_all["type"] == "expense"].sort_values("date")
-    daily_total_expense = df_all_expense.groupby(df_all_expense["date"].dt.date)["amount"].sum()
-
-    if not daily_total_expense.empty:
-        plt.figure(figsize=(12, 6))
-        plt.plot(daily_total_expense.index, daily_total_expense.cumsum(), marker="o", linestyle="-")
-        plt.title(f"{output_filename_prefix} 累计支出走势 (所有月份)")
-        plt.xlabel("日期")
-        plt.ylabel("累计金额")
-        plt.grid(True)
-        plt.xticks(rotation=45)
-        plt.tight_layout()
+    total_days, total_cumsum = _daily_cumsum(np.concatenate(expense_dates), np.concatenate(expense_amounts))
+
+    if len(total_days):
         total_line_path = REPORT_DIR / f"{output_filename_prefix}_total_line.png"
-        plt.savefig(total_line_path, bbox_inches="tight")
-        plt.close()
-        md += f"\n### 所有月份累计支出曲线\n![]({total_line_path.name})\n"
-        print(f"📈 总计日级支出折线图 → {total_line_path}")
+        chart_tasks.append((_render_lines, (total_line_path, (12, 6), f"{output_filename_prefix} 累计支出走势 (所有月份)", "日期", "累计金额",
+                                            [(total_days, total_cumsum, {"marker": "o", "linestyle": "-"})],
+                                            True)))
+        md_parts.append(f"\n### 所有月份累计支出曲线\n![]({total_line_path.name})\n")
+        chart_logs.append(f"📈 总计日级支出折线图 → {total_line_path}")
     
     # 月级收入和支出折线图 (所有月)
     if monthly_summary_data:
@@ -261,25 +293,22 @@ def export_multi_month_md(months: list, year: str = None):
         df_monthly_summary["month_dt"] = pd.to_datetime(df_monthly_summary["month"])
         df_monthly_summary = df_monthly_summary.sort_values("month_dt")
 
-        plt.figure(figsize=(12, 6))
-        plt.plot(df_monthly_summary["month"], df_monthly_summary["income"], marker="o", label="月收入")
-        plt.plot(df_monthly_summary["month"], df_monthly_summary["expense"], marker="x", label="月支出")
-        plt.title(f"{output_filename_prefix} 月度收入与支出走势")
-        plt.xlabel("月份")
-        plt.ylabel("金额")
-        plt.grid(True)
-        plt.legend()
-        plt.xticks(rotation=45)
-        plt.tight_layout()
+        month_labels = df_monthly_summary["month"].tolist()
         monthly_income_expense_path = REPORT_DIR / f"{output_filename_prefix}_monthly_income_expense.png"
-        plt.savefig(monthly_income_expense_path, bbox_inches="tight")
-        plt.close()
-        md += f"\n### 月度收入与支出折线图\n![]({monthly_income_expense_path.name})\n"
-        print(f"📊 月度收入/支出折线图 → {monthly_income_expense_path}")
+        chart_tasks.append((_render_lines, (monthly_income_expense_path, (12, 6), f"{output_filename_prefix} 月度收入与支出走势", "月份", "金额",
+                                            [(month_labels, df_monthly_summary["income"].to_numpy(), {"marker": "o", "label": "月收入"}),
+                                             (month_labels, df_monthly_summary["expense"].to_numpy(), {"marker": "x", "label": "月支出"})],
+                                            True, True)))
+        md_parts.append(f"\n### 月度收入与支出折线图\n![]({monthly_income_expense_path.name})\n")
+        chart_logs.append(f"📊 月度收入/支出折线图 → {monthly_income_expense_path}")
+
+    _render_charts(chart_tasks)
+    for line in chart_logs:
+        print(line)
 
     md_path = REPORT_DIR / f"{output_filename_prefix}.md"
     with open(md_path, "w", encoding="utf-8") as f:
-        f.write(md)
+        f.write("".join(md_parts))
     print(f"✅ 已导出 Markdown 报告 → {md_path}")
 
 def get_months_in_range(start_month_str, end_month_str):
@@ -287,20 +316,19 @@ def get_months_in_range(start_month_str, end_month_str):
     start_year, start_month = map(int, start_month_str.split('-'))
     end_year, end_month = map(int, end_month_str.split('-'))
 
-    months = []
-    current_date = datetime.date(start_year, start_month, 1)
-    while current_date <= datetime.date(end_year, end_month, 1):
-        months.append(current_date.strftime("%Y-%m"))
-        # 移动到下个月
-        if current_date.month == 12:
-            current_date = datetime.date(current_date.year + 1, 1, 1)
-        else:
-            current_date = datetime.date(current_date.year, current_date.month + 1, 1)
-    return months
+    if not (1 <= start_month <= 12 and 1 <= end_month <= 12):
+        raise ValueError("月份必须在 01-12 之间")
+
+    # 换算为从公元 0 年起的月序号，直接按整数区间生成
+    start = start_year * 12 + start_month - 1
+    end = end_year * 12 + end_month - 1
+    return [f"{i // 12:04d}-{i % 12 + 1:02d}" for i in range(start, end + 1)]
+
+@lru_cache(maxsize=64)
+def _months_in_year(year_str):
+    return tuple(f"{year_str}-{month_num:02d}" for month_num in range(1, 13))
 
 def get_months_in_year(year_str):
     """获取一年中的所有月份字符串 (YYYY-MM)"""
-    months = []
-    for month_num in range(1, 13):
-        months.append(f"{year_str}-{month_num:02d}")
-    return months
+    # 缓存的是不可变的 tuple，每次返回新列表，调用方可以放心修改
+    return list(_months_in_year(year_str))